@@ -1,5 +1,8 @@
+import argparse
 import numpy as np
-from chess_game import ChessGame, Piece, Pawn, Rook, Knight, Bishop, Queen, King
+import chess_game
+from chess_game import ChessGame, Piece, Pawn, Rook, Knight, Bishop, Queen, King, square_index
+from chess_game import WIDTH, HEIGHT, BOARD_SIZE, BOARD_RECT, SQ_SIZE, LIGHT_SQUARE, render_text
 import pygame  
 
 pieces = {
@@ -11,36 +14,32 @@ pieces = {
     'pawn': Pawn,
 }
 
+# Q-table rows are picked by the low bits of the Zobrist hash. The full
+# 64-bit key can't index an array, and each row costs 16 KiB once touched.
+Q_TABLE_BITS = 14
+NUM_ACTIONS = 64 * 64  # Every (from square, to square) pair
+
+def action_index(action):
+    start_pos, end_pos = action
+    return square_index(start_pos) * 64 + square_index(end_pos)
+
 class ChessAI:
-    def __init__(self):
-        self.q_table = {}  # This will store the Q-values for state-action pairs
+    def __init__(self, table_bits=Q_TABLE_BITS):
+        # Q-values for state-action pairs, one row per state and column per action
+        self.q_table = np.zeros((1 << table_bits, NUM_ACTIONS), dtype=np.float32)
+        self.state_mask = (1 << table_bits) - 1
         self.learning_rate = 0.1
         self.discount_factor = 0.9
         self.exploration_rate = 0.1
 
     def get_state_representation(self, game):
-        state = []
-        for row in range(8):
-            for col in range(8):
-                piece = game.board[row][col]
-                if piece is None:
-                    continue
-                else:
-                    # Use lowercase for black pieces, uppercase for white pieces
-                    state.append(piece)
-        # Add current turn to the state
-
-        # Convert list to tuple so it's hashable
-        return tuple(state)
+        return game.zobrist & self.state_mask
 
     def get_possible_actions(self, game: ChessGame):
-        # TODO: Implement a function to get all possible moves in the current game state
-        # This should return a list of (start_pos, end_pos) tuples for all legal moves
-        state = self.get_state_representation(game)
+        # Returns a list of (start_pos, end_pos) tuples for all legal moves
         results = []
-        for p in state:
-            for move in p.get_valid_moves(game.board):
-                results.append((p.position, move))
+        for p in game.pieces_by_color[game.turn]:
+            results.extend((p.position, move) for move in game.get_legal_moves(p))
         return results
 
     def choose_action(self, game, state):
@@ -48,43 +47,101 @@ class ChessAI:
             # Explore: choose a random action
             actions = self.get_possible_actions(game)
             rand = np.random.randint(0, len(actions))
-            print(actions[rand])
             return actions[rand]
         else:
-            # Exploit: choose the best action based on Q-values
-            # TODO: Implement logic to select the action with the highest Q-value
-            pass
-
-    def update_q_value(self, state, action, next_state, reward):
-        # TODO: Implement the Q-learning update rule
-        # Q(s,a) = Q(s,a) + learning_rate * (reward + discount_factor * max(Q(s',a')) - Q(s,a))
-        pass
+            # Exploit: choose the legal action with the highest Q-value
+            actions = self.get_possible_actions(game)
+            legal = [action_index(action) for action in actions]
+            return actions[int(np.argmax(self.q_table[state, legal]))]
+
+    def update_q_value(self, state, action, next_state, reward, done=False):
+        # Negamax form: s' is the opponent's turn, so its best value counts against the mover
+        # Q(s,a) = Q(s,a) + learning_rate * (reward - discount_factor * max(Q(s',a')) - Q(s,a))
+        # A finished game has no next state; its row may belong to unrelated positions
+        a = action_index(action)
+        target = reward
+        if not done:
+            target -= self.discount_factor * self.q_table[next_state].max()
+        self.q_table[state, a] += self.learning_rate * (target - self.q_table[state, a])
 
     def get_reward(self, game):
-        # TODO: Implement a reward function
-        # This could be based on material advantage, board control, or game outcome
-        pass
-
-def train_ai(num_episodes):
-    ai = ChessAI()
-
-    for episode in range(num_episodes):
-        game = ChessGame()
-        state = ai.get_state_representation(game)
-
-        while not game.game_over:
-            action = ai.choose_action(game, state)
-            # TODO: Apply the chosen action to the game
-            
-            next_state = ai.get_state_representation(game)
-            reward = ai.get_reward(game)
-
-            ai.update_q_value(state, action, next_state, reward)
-
-            state = next_state
-
-        print(f"Episode {episode + 1}/{num_episodes} completed")
-
+        # Only a checkmate scores, in favour of the side that just moved
+        if game.game_over and game.game_result.endswith("checkmate!"):
+            return 1.0
+        return 0.0
+
+def apply_action(game, action):
+    # Play a (start_pos, end_pos) action through the same path as a mouse move
+    start_pos, end_pos = action
+    game.selected_piece = game.board[start_pos[0]][start_pos[1]]
+    game.valid_moves = game.get_legal_moves(game.selected_piece)
+    moved = game.move_piece(game.get_screen_position(end_pos))
+    if game.promotion_pawn:
+        game.promote_pawn(Queen)
+    game.selected_piece = None
+    game.valid_moves = []
+    return moved
+
+class VecChessEnv:
+    # Steps several games together so one training step advances all of them.
+    # state_fn maps a game to the state the agent sees, e.g. ChessAI.get_state_representation
+    def __init__(self, num_envs, state_fn, max_moves=200):
+        self.num_envs = num_envs
+        self.state_fn = state_fn
+        self.max_moves = max_moves
+        self.games = []
+        self.move_counts = []
+        self.dones = []
+
+    def reset(self):
+        self.games = [ChessGame() for _ in range(self.num_envs)]
+        self.move_counts = [0] * self.num_envs
+        self.dones = [False] * self.num_envs
+        return self.get_states()
+
+    def step(self, actions):
+        # None skips a game for this step, e.g. once it has finished
+        for i, (game, action) in enumerate(zip(self.games, actions)):
+            if self.dones[i] or action is None:
+                continue
+            if apply_action(game, action):
+                self.move_counts[i] += 1
+            self.dones[i] = game.game_over or self.move_counts[i] >= self.max_moves
+        return self.get_states(), list(self.dones)
+
+    def get_states(self):
+        return [self.state_fn(game) for game in self.games]
+
+def train_ai(num_episodes, num_envs=1):
+    # Training never draws, so don't load piece images
+    chess_game.HEADLESS = True
+    try:
+        ai = ChessAI()
+        episode = 0
+
+        while episode < num_episodes:
+            env = VecChessEnv(min(num_envs, num_episodes - episode), ai.get_state_representation)
+            states = env.reset()
+
+            while not all(env.dones):
+                actions = [None if done else ai.choose_action(game, state)
+                           for game, state, done in zip(env.games, states, env.dones)]
+                next_states, _ = env.step(actions)
+
+                for i, game in enumerate(env.games):
+                    if actions[i] is None:
+                        continue
+                    reward = ai.get_reward(game)
+
+                    ai.update_q_value(states[i], actions[i], next_states[i], reward, game.game_over)
+
+                states = next_states
+
+            episode += env.num_envs
+            print(f"Episode {episode}/{num_episodes} completed")
+    finally:
+        # Reset even if training fails, or later games would have no images to draw
+        chess_game.HEADLESS = False
     return ai
 
 def play_against_ai(ai):
@@ -97,6 +154,7 @@ def play_against_ai(ai):
     game = ChessGame('white')  # Human player is always white for simplicity
     selected_piece = None
     drag_pos = None
+    drag_rect = None  # Where the dragged piece was drawn last frame
 
     while not game.game_over:
         for event in pygame.event.get():
@@ -123,37 +181,47 @@ def play_against_ai(ai):
                         x, y = event.pos
                         if y < BOARD_SIZE:  # Release is on the board
                             end_col, end_row = x // SQ_SIZE, y // SQ_SIZE
-                            start_row, start_col = selected_piece.position
-                            move = ((start_row, start_col), (end_row, end_col))
-                            if move in game.get_valid_moves(selected_piece):
-                                game.move_piece(selected_piece, (end_row, end_col))
+                            # Checked against the per-turn legal move cache, which apply_action reuses
+                            if (end_row, end_col) in game.get_legal_moves(selected_piece):
+                                apply_action(game, (selected_piece.position, (end_row, end_col)))
                         selected_piece = None
                         drag_pos = None
 
         if game.turn == 'black' and not game.game_over:  # AI's turn
             state = ai.get_state_representation(game)
             action = ai.choose_action(game, state)
-            start_pos, end_pos = action
-            piece = game.board[start_pos[0]][start_pos[1]]
-            game.move_piece(piece, end_pos)
-
-        # Draw the game state
-        screen.fill(LIGHT_SQUARE)
-        game.draw_board(screen)
+            apply_action(game, action)
+
+        # Draw the game state, repainting only the changed squares when possible
+        if drag_rect:
+            game.dirty_rects.append(drag_rect)
+            drag_rect = None
+        if game.full_redraw:
+            screen.fill(LIGHT_SQUARE)
+            game.draw_board_full(screen)
+            update_rects = None
+        else:
+            update_rects = game.draw_board_dirty(screen)
 
-        # Draw dragged piece
+        # Draw dragged piece, kept on the board since only board squares get repainted
         if selected_piece and drag_pos:
             x, y = drag_pos
-            screen.blit(selected_piece.image, (x - SQ_SIZE // 2, y - SQ_SIZE // 2))
+            screen.set_clip(BOARD_RECT)
+            drag_rect = screen.blit(selected_piece.image, (x - SQ_SIZE // 2, y - SQ_SIZE // 2))
+            screen.set_clip(None)
+            if update_rects is not None:
+                update_rects.append(drag_rect)
 
         # Draw game over message if applicable
         if game.game_over:
-            font = pygame.font.Font(None, 36)
-            text = font.render(game.game_result, True, BLACK)
+            text = render_text(game.game_result, 36)
             text_rect = text.get_rect(center=(WIDTH // 2, HEIGHT + 25))
             screen.blit(text, text_rect)
 
-        pygame.display.flip()
+        if update_rects is None:
+            pygame.display.flip()
+        else:
+            pygame.display.update(update_rects)
         clock.tick(60)
 
     # Game over, wait for user to close the window
@@ -164,5 +232,9 @@ def play_against_ai(ai):
                 return
 
 if __name__ == "__main__":
-    trained_ai = train_ai(num_episodes=1000)
+    parser = argparse.ArgumentParser(description="Train the chess AI, then play against it")
+    parser.add_argument("--num-envs", type=int, default=1, help="number of games to train on side by side")
+    args = parser.parse_args()
+
+    trained_ai = train_ai(num_episodes=1000, num_envs=args.num_envs)
     play_against_ai(trained_ai)
\ No newline at end of file
@@ -1,8 +1,10 @@
 import pygame
 import sys
 import os
+import random
 from abc import ABC, abstractmethod
 from collections import Counter
+from typing import Iterable, Iterator, Optional
 
 # Initialize Pygame
 pygame.init()
@@ -12,6 +14,7 @@ WIDTH, HEIGHT = 480, 500
 BOARD_SIZE = 480
 DIMENSION = 8
 SQ_SIZE = BOARD_SIZE // DIMENSION
+BOARD_RECT = pygame.Rect(0, 0, BOARD_SIZE, BOARD_SIZE)
 
 # Colors
 LIGHT_SQUARE = (240, 217, 181)  # Light brown
@@ -22,411 +25,761 @@ CHECK_INDICATOR = (255, 0, 0)   # Red for check indicator
 BLACK = (0, 0, 0)
 WHITE = (255, 255, 255)
 
+# Fonts are built once; rendered labels are cached by (text, size)
+_FONT_30 = pygame.font.Font(None, 30)
+_FONT_36 = pygame.font.Font(None, 36)
+_FONT_50 = pygame.font.Font(None, 50)
+_FONTS = {30: _FONT_30, 36: _FONT_36, 50: _FONT_50}
+_TEXT_CACHE: dict[tuple[str, int], pygame.Surface] = {}
+
+def render_text(text: str, size: int) -> pygame.Surface:
+    key = (text, size)
+    if key not in _TEXT_CACHE:
+        _TEXT_CACHE[key] = _FONTS[size].render(text, True, BLACK)
+    return _TEXT_CACHE[key]
+
+# Set when nothing will be drawn (e.g. AI training) to skip loading images
+HEADLESS = False
+_IMG_CACHE: dict[tuple[str, str], pygame.Surface] = {}  # (color, piece name) -> scaled surface
+
+# Bitboards
+# Square index is row * 8 + col, so bit 0 is the top-left square (a8) and
+# bit 63 the bottom-right (h1), matching the (row, col) positions used below.
+KNIGHT_OFFSETS = [(-2, -1), (-2, 1), (-1, -2), (-1, 2),
+                  (1, -2), (1, 2), (2, -1), (2, 1)]
+KING_OFFSETS = [(0, 1), (1, 0), (0, -1), (-1, 0),
+                (1, 1), (1, -1), (-1, 1), (-1, -1)]
+ROOK_DIRECTIONS = [(0, 1), (1, 0), (0, -1), (-1, 0)]
+BISHOP_DIRECTIONS = [(1, 1), (1, -1), (-1, 1), (-1, -1)]
+
+Square = tuple[int, int]  # (row, col)
+Board = list[list[Optional['Piece']]]
+
+def square_index(position: Square) -> int:
+    return position[0] * 8 + position[1]
+
+def squares_from_bitboard(bb: int) -> Iterator[Square]:
+    while bb:
+        lsb = bb & -bb
+        yield divmod(lsb.bit_length() - 1, 8)
+        bb ^= lsb
+
+def _step_destinations(offsets: list[Square]) -> list[list[Square]]:
+    table = []
+    for sq in range(64):
+        row, col = divmod(sq, 8)
+        table.append([(row + dr, col + dc) for dr, dc in offsets
+                      if 0 <= row + dr < 8 and 0 <= col + dc < 8])
+    return table
+
+def _step_attacks(destinations: list[list[Square]]) -> list[int]:
+    return [sum(1 << square_index(square) for square in squares) for squares in destinations]
+
+def _ray_attacks(sq: int, directions: list[Square], occupancy: int) -> int:
+    row, col = divmod(sq, 8)
+    bb = 0
+    for dr, dc in directions:
+        r, c = row + dr, col + dc
+        while 0 <= r < 8 and 0 <= c < 8:
+            bit = 1 << (r * 8 + c)
+            bb |= bit
+            if occupancy & bit:
+                break
+            r, c = r + dr, c + dc
+    return bb
+
+def _blocker_mask(sq: int, directions: list[Square]) -> int:
+    # The last square of each ray can't shadow anything, so it's left out
+    row, col = divmod(sq, 8)
+    bb = 0
+    for dr, dc in directions:
+        r, c = row + dr, col + dc
+        while 0 <= r + dr < 8 and 0 <= c + dc < 8:
+            bb |= 1 << (r * 8 + c)
+            r, c = r + dr, c + dc
+    return bb
+
+def _slider_tables(directions: list[Square]) -> tuple[list[int], list[dict[int, int]]]:
+    masks: list[int] = []
+    tables: list[dict[int, int]] = []
+    for sq in range(64):
+        mask = _blocker_mask(sq, directions)
+        table: dict[int, int] = {}
+        # Carry-Rippler walk over every subset of the blocker mask
+        blockers = 0
+        while True:
+            table[blockers] = _ray_attacks(sq, directions, blockers)
+            blockers = (blockers - mask) & mask
+            if not blockers:
+                break
+        masks.append(mask)
+        tables.append(table)
+    return masks, tables
+
+# In-board destination squares per origin square, for the Piece board
+KNIGHT_DESTS = _step_destinations(KNIGHT_OFFSETS)
+KING_DESTS = _step_destinations(KING_OFFSETS)
+
+KNIGHT_ATTACKS = _step_attacks(KNIGHT_DESTS)
+KING_ATTACKS = _step_attacks(KING_DESTS)
+PAWN_ATTACKS = {'white': _step_attacks(_step_destinations([(-1, -1), (-1, 1)])),
+                'black': _step_attacks(_step_destinations([(1, -1), (1, 1)]))}
+# Python ints have no cheap wrapping 64-bit multiply, so the per-square dict
+# plays the part of the magic hash: masked occupancy -> attack set.
+ROOK_MASKS, ROOK_ATTACKS = _slider_tables(ROOK_DIRECTIONS)
+BISHOP_MASKS, BISHOP_ATTACKS = _slider_tables(BISHOP_DIRECTIONS)
+
+def rook_attacks(sq: int, occupancy: int) -> int:
+    return ROOK_ATTACKS[sq][occupancy & ROOK_MASKS[sq]]
+
+def bishop_attacks(sq: int, occupancy: int) -> int:
+    return BISHOP_ATTACKS[sq][occupancy & BISHOP_MASKS[sq]]
+
+def queen_attacks(sq: int, occupancy: int) -> int:
+    return rook_attacks(sq, occupancy) | bishop_attacks(sq, occupancy)
+
+# Zobrist keys, laid out as in Polyglot: one per piece bitboard and square,
+# one per en passant file and one for white to move. Fixed seed so hashes
+# are stable between runs.
+_zobrist_rng = random.Random(0x2F1B7A9C)
+ZOBRIST_PIECES = [[_zobrist_rng.getrandbits(64) for _ in range(64)] for _ in range(12)]
+ZOBRIST_EP = [_zobrist_rng.getrandbits(64) for _ in range(8)]
+ZOBRIST_SIDE = _zobrist_rng.getrandbits(64)
+
 class Piece(ABC):
-    def __init__(self, color, position):
+    def __init__(self, color: str, position: Square) -> None:
         self.color = color
         self.position = position
-        self.image = None
-        self.rect = None
+        self.image: Optional[pygame.Surface] = None
+        self.rect: pygame.Rect  # Set by load_image
         self.load_image()
 
+    # Moves are generated lazily so callers can stop at the first one they need
+    @abstractmethod
+    def iter_valid_moves(self, board: Board) -> Iterable[Square]:
+        pass
+
+    def get_valid_moves(self, board: Board) -> list[Square]:
+        return list(self.iter_valid_moves(board))
+
+    # Bitboard of the squares this piece attacks given the board occupancy
     @abstractmethod
-    def get_valid_moves(self, board):
+    def attacks(self, occupancy: int) -> int:
         pass
 
-    def load_image(self):
+    def load_image(self) -> None:
+        if HEADLESS:
+            self.rect = pygame.Rect(0, 0, SQ_SIZE, SQ_SIZE)
+            self.update_rect()
+            return
         piece_name = self.__class__.__name__.lower()
-        filename = f"{self.color}-{piece_name}.png"
-        path = os.path.join("pieces", filename)
-        self.image = pygame.image.load(path)
-        self.image = pygame.transform.scale(self.image, (SQ_SIZE, SQ_SIZE))
+        key = (self.color, piece_name)
+        if key not in _IMG_CACHE:
+            filename = f"{self.color}-{piece_name}.png"
+            path = os.path.join("pieces", filename)
+            image = pygame.image.load(path)
+            _IMG_CACHE[key] = pygame.transform.scale(image, (SQ_SIZE, SQ_SIZE))
+        self.image = _IMG_CACHE[key]
         self.rect = self.image.get_rect()
         self.update_rect()
 
-    def update_rect(self):
+    def update_rect(self) -> None:
         self.rect.topleft = (self.position[1] * SQ_SIZE, self.position[0] * SQ_SIZE)
 
 class Pawn(Piece):
-    def __init__(self, color, position):
+    def __init__(self, color: str, position: Square) -> None:
         super().__init__(color, position)
         self.has_moved = False
         self.en_passant_vulnerable = False
 
-    def get_valid_moves(self, board):
+    def iter_valid_moves(self, board: Board) -> Iterator[Square]:
         row, col = self.position
-        moves = []
         direction = -1 if self.color == 'white' else 1
         
         # Move forward
-        if 0 <= row + direction < 8 and board[row + direction][col] is None:
-            moves.append((row + direction, col))
+        if not (row + direction) & ~7 and board[row + direction][col] is None:
+            yield (row + direction, col)
             # Double move from starting position
             if not self.has_moved and board[row + 2*direction][col] is None:
-                moves.append((row + 2*direction, col))
+                yield (row + 2*direction, col)
         
         # Capture diagonally
         for dcol in [-1, 1]:
-            if 0 <= row + direction < 8 and 0 <= col + dcol < 8:
-                if board[row + direction][col + dcol] is not None:
-                    if board[row + direction][col + dcol].color != self.color:
-                        moves.append((row + direction, col + dcol))
+            if not (row + direction | col + dcol) & ~7:
+                target = board[row + direction][col + dcol]
+                if target is not None:
+                    if target.color != self.color:
+                        yield (row + direction, col + dcol)
                 
                 # En passant
                 elif (row == 3 and self.color == 'white') or (row == 4 and self.color == 'black'):
-                    if isinstance(board[row][col + dcol], Pawn) and board[row][col + dcol].en_passant_vulnerable:
-                        moves.append((row + direction, col + dcol))
-        
-        return moves
+                    beside = board[row][col + dcol]
+                    if isinstance(beside, Pawn) and beside.en_passant_vulnerable:
+                        yield (row + direction, col + dcol)
+
+    def attacks(self, occupancy: int) -> int:
+        return PAWN_ATTACKS[self.color][square_index(self.position)]
+
+# Coordinates are on the board iff no bit above the low three is set, so
+# `(row | col) & ~7` replaces `0 <= row < 8 and 0 <= col < 8` here, in
+# Pawn.iter_valid_moves and in is_square_under_attack (negative numbers
+# have those bits set too).
+def _ray_moves(position: Square, color: str, board: Board, directions: list[Square]) -> Iterator[Square]:
+    for dr, dc in directions:
+        for i in range(1, 8):
+            row, col = position[0] + i*dr, position[1] + i*dc
+            if (row | col) & ~7:
+                break
+            piece = board[row][col]
+            if piece is None:
+                yield (row, col)
+            elif piece.color != color:
+                yield (row, col)
+                break
+            else:
+                break
+
+def _straight_moves(position: Square, color: str, board: Board) -> Iterator[Square]:
+    return _ray_moves(position, color, board, ROOK_DIRECTIONS)
+
+def _diagonal_moves(position: Square, color: str, board: Board) -> Iterator[Square]:
+    return _ray_moves(position, color, board, BISHOP_DIRECTIONS)
 
 class Rook(Piece):
-    def get_valid_moves(self, board):
-        return self._get_straight_moves(board)
-
-    def _get_straight_moves(self, board):
-        moves = []
-        directions = [(0, 1), (1, 0), (0, -1), (-1, 0)]
-        for dr, dc in directions:
-            for i in range(1, 8):
-                row, col = self.position[0] + i*dr, self.position[1] + i*dc
-                if 0 <= row < 8 and 0 <= col < 8:
-                    if board[row][col] is None:
-                        moves.append((row, col))
-                    elif board[row][col].color != self.color:
-                        moves.append((row, col))
-                        break
-                    else:
-                        break
-                else:
-                    break
-        return moves
+    def iter_valid_moves(self, board: Board) -> Iterator[Square]:
+        return _straight_moves(self.position, self.color, board)
+
+    def attacks(self, occupancy: int) -> int:
+        return rook_attacks(square_index(self.position), occupancy)
 
 class Knight(Piece):
-    def get_valid_moves(self, board):
-        moves = []
-        knight_moves = [(-2, -1), (-2, 1), (-1, -2), (-1, 2),
-                        (1, -2), (1, 2), (2, -1), (2, 1)]
-        for dr, dc in knight_moves:
-            row, col = self.position[0] + dr, self.position[1] + dc
-            if 0 <= row < 8 and 0 <= col < 8:
-                if board[row][col] is None or board[row][col].color != self.color:
-                    moves.append((row, col))
-        return moves
+    def attacks(self, occupancy: int) -> int:
+        return KNIGHT_ATTACKS[square_index(self.position)]
+
+    def iter_valid_moves(self, board: Board) -> Iterator[Square]:
+        r, c = self.position
+        own = self.color
+        return ((rr, cc) for rr, cc in KNIGHT_DESTS[r*8 + c]
+                if (target := board[rr][cc]) is None or target.color != own)
 
 class Bishop(Piece):
-    def get_valid_moves(self, board):
-        return self._get_diagonal_moves(board)
-
-    def _get_diagonal_moves(self, board):
-        moves = []
-        directions = [(1, 1), (1, -1), (-1, 1), (-1, -1)]
-        for dr, dc in directions:
-            for i in range(1, 8):
-                row, col = self.position[0] + i*dr, self.position[1] + i*dc
-                if 0 <= row < 8 and 0 <= col < 8:
-                    if board[row][col] is None:
-                        moves.append((row, col))
-                    elif board[row][col].color != self.color:
-                        moves.append((row, col))
-                        break
-                    else:
-                        break
-                else:
-                    break
-        return moves
+    def iter_valid_moves(self, board: Board) -> Iterator[Square]:
+        return _diagonal_moves(self.position, self.color, board)
 
-class Queen(Piece):
-    def get_valid_moves(self, board):
-        return self._get_straight_moves(board) + self._get_diagonal_moves(board)
+    def attacks(self, occupancy: int) -> int:
+        return bishop_attacks(square_index(self.position), occupancy)
 
-    def _get_straight_moves(self, board):
-        return Rook(self.color, self.position)._get_straight_moves(board)
+class Queen(Piece):
+    def iter_valid_moves(self, board: Board) -> Iterator[Square]:
+        yield from _straight_moves(self.position, self.color, board)
+        yield from _diagonal_moves(self.position, self.color, board)
 
-    def _get_diagonal_moves(self, board):
-        return Bishop(self.color, self.position)._get_diagonal_moves(board)
+    def attacks(self, occupancy: int) -> int:
+        return queen_attacks(square_index(self.position), occupancy)
 
 class King(Piece):
-    def get_valid_moves(self, board):
-        moves = []
-        king_moves = [(0, 1), (1, 0), (0, -1), (-1, 0),
-                      (1, 1), (1, -1), (-1, 1), (-1, -1)]
-        for dr, dc in king_moves:
-            row, col = self.position[0] + dr, self.position[1] + dc
-            if 0 <= row < 8 and 0 <= col < 8:
-                if board[row][col] is None or board[row][col].color != self.color:
-                    moves.append((row, col))
-        return moves
+    def attacks(self, occupancy: int) -> int:
+        return KING_ATTACKS[square_index(self.position)]
+
+    def iter_valid_moves(self, board: Board) -> Iterator[Square]:
+        r, c = self.position
+        own = self.color
+        return ((rr, cc) for rr, cc in KING_DESTS[r*8 + c]
+                if (target := board[rr][cc]) is None or target.color != own)
+
+# Index into ChessGame.bb: piece type, plus 6 for black
+PIECE_INDEX = {Pawn: 0, Knight: 1, Bishop: 2, Rook: 3, Queen: 4, King: 5}
+COLOR_OFFSET = {'white': 0, 'black': 6}
+
+def bitboard_index(piece: Piece) -> int:
+    return PIECE_INDEX[type(piece)] + COLOR_OFFSET[piece.color]
+
+def opponent(color: str) -> str:
+    return 'black' if color == 'white' else 'white'
+
+# What _make needs to take a move back: start, end, captured piece and its square
+Undo = tuple[Square, Square, Optional[Piece], Square]
 
 class ChessGame:
-    def __init__(self, player_color='white'):
-        self.board = [[None for _ in range(8)] for _ in range(8)]
+    def __init__(self, player_color: str = 'white') -> None:
+        self.board: Board = [[None for _ in range(8)] for _ in range(8)]
         self._initialize_pieces()
         self.turn = 'white'
-        self.selected_piece = None
+        self.selected_piece: Optional[Piece] = None
         self.dragging = False
-        self.valid_moves = []
+        self.valid_moves: list[Square] = []
         self.player_color = player_color
         self.board_flipped = player_color == 'black'
         self.in_check = {'white': False, 'black': False}
         self.game_over = False
-        self.game_result = None
-        self.position_history = []
-        self.last_move = None
-        self.promotion_pawn = None
-
-    def _initialize_pieces(self):
+        self.game_result: Optional[str] = None
+        self.position_history: list[int] = []
+        self.position_counts: Counter[int] = Counter()
+        self.ep_target: Optional[Pawn] = None  # Pawn that can be taken en passant next move
+        self.zobrist ^= ZOBRIST_SIDE
+        self.last_move: Optional[tuple[int, int, int, int]] = None
+        self.promotion_pawn: Optional[Pawn] = None
+        self.legal_moves: Optional[dict[Piece, list[Square]]] = None  # Piece -> legal moves for the side to move, see _ensure_legal_cache
+        # Screen areas that changed since the last draw, or a flag to repaint everything
+        self.dirty_rects: list[pygame.Rect] = []
+        self.full_redraw = True
+
+    def _initialize_pieces(self) -> None:
         # Initialize pawns
         for col in range(8):
             self.board[1][col] = Pawn('black', (1, col))
             self.board[6][col] = Pawn('white', (6, col))
 
         # Initialize other pieces
-        piece_order = [Rook, Knight, Bishop, Queen, King, Bishop, Knight, Rook]
+        piece_order: list[type[Piece]] = [Rook, Knight, Bishop, Queen, King, Bishop, Knight, Rook]
         for col, piece_class in enumerate(piece_order):
             self.board[0][col] = piece_class('black', (0, col))
             self.board[7][col] = piece_class('white', (7, col))
+        self.king_sq = {'white': (7, 4), 'black': (0, 4)}
 
-    def draw_board(self, screen):
+        # Per-color pieces. The pieces are dict keys rather than a set so
+        # iteration order, and so move order, doesn't depend on id()
+        self.pieces_by_color: dict[str, dict[Piece, None]] = {'white': {}, 'black': {}}
+        for row in self.board:
+            for piece in row:
+                if piece:
+                    self.pieces_by_color[piece.color][piece] = None
+
+        # One bitboard per piece type and color, plus occupancy masks
+        self.bb = [0] * 12
+        self.occupancy = {'white': 0, 'black': 0}
+        self.occ = 0
+        self.zobrist = 0
+        for row in self.board:
+            for piece in row:
+                if piece:
+                    self._toggle_piece(piece, piece.position)
+
+    def _toggle_piece(self, piece: Piece, square: Square) -> None:
+        sq = square_index(square)
+        bit = 1 << sq
+        index = bitboard_index(piece)
+        self.bb[index] ^= bit
+        self.zobrist ^= ZOBRIST_PIECES[index][sq]
+        self.occupancy[piece.color] ^= bit
+        self.occ = self.occupancy['white'] | self.occupancy['black']
+
+    def draw_board_full(self, screen: pygame.Surface) -> None:
         for row in range(DIMENSION):
             for col in range(DIMENSION):
-                color = LIGHT_SQUARE if (row + col) % 2 != 0 else DARK_SQUARE
-                if self.board_flipped:
-                    pygame.draw.rect(screen, color, ((7-col) * SQ_SIZE, (7-row) * SQ_SIZE, SQ_SIZE, SQ_SIZE))
-                else:
-                    pygame.draw.rect(screen, color, (col * SQ_SIZE, row * SQ_SIZE, SQ_SIZE, SQ_SIZE))
-                
-                piece = self.board[row][col]
-                if piece:
-                    screen_pos = self.get_screen_position((row, col))
-                    screen.blit(piece.image, screen_pos)
-                    
-                    # Highlight king if in check
-                    if isinstance(piece, King) and self.in_check[piece.color]:
-                        pygame.draw.rect(screen, CHECK_INDICATOR, (*screen_pos, SQ_SIZE, SQ_SIZE), 3)
-
-        # Draw valid move indicators
-        for move in self.valid_moves:
-            screen_pos = self.get_screen_position(move)
-            pygame.draw.circle(screen, MOVE_INDICATOR, 
-                               (screen_pos[0] + SQ_SIZE // 2, screen_pos[1] + SQ_SIZE // 2), 
+                self._draw_square(screen, (row, col))
+        self._draw_dragged_piece(screen)
+        self.dirty_rects = []
+        self.full_redraw = False
+
+    def draw_board_dirty(self, screen: pygame.Surface) -> list[pygame.Rect]:
+        # Repaint only the squares under the dirty rects; returns the screen areas to update
+        rects = self.dirty_rects
+        self.dirty_rects = []
+        squares = set()
+        for rect in rects:
+            rect = rect.clip(BOARD_RECT)
+            if not rect:
+                continue
+            for x in range(rect.left // SQ_SIZE, (rect.right - 1) // SQ_SIZE + 1):
+                for y in range(rect.top // SQ_SIZE, (rect.bottom - 1) // SQ_SIZE + 1):
+                    squares.add(self.get_board_position((x * SQ_SIZE, y * SQ_SIZE)))
+        for square in squares:
+            self._draw_square(screen, square)
+        if self.selected_piece and self.dragging:
+            self._draw_dragged_piece(screen)
+            rects.append(self.selected_piece.rect.clip(BOARD_RECT))
+        return rects
+
+    def _draw_square(self, screen: pygame.Surface, square: Square) -> None:
+        row, col = square
+        screen_pos = self.get_screen_position(square)
+        color = LIGHT_SQUARE if (row + col) % 2 != 0 else DARK_SQUARE
+        pygame.draw.rect(screen, color, (*screen_pos, SQ_SIZE, SQ_SIZE))
+
+        piece = self.board[row][col]
+        if piece:
+            if piece.image:
+                screen.blit(piece.image, screen_pos)
+
+            # Highlight king if in check
+            if isinstance(piece, King) and self.in_check[piece.color]:
+                pygame.draw.rect(screen, CHECK_INDICATOR, (*screen_pos, SQ_SIZE, SQ_SIZE), 3)
+
+        # Draw valid move indicator
+        if square in self.valid_moves:
+            pygame.draw.circle(screen, MOVE_INDICATOR,
+                               (screen_pos[0] + SQ_SIZE // 2, screen_pos[1] + SQ_SIZE // 2),
                                SQ_SIZE // 8)
 
-        # Draw the selected piece last (on top)
-        if self.selected_piece and self.dragging:
+    def _draw_dragged_piece(self, screen: pygame.Surface) -> None:
+        # Drawn last so it's on top, and kept off the button area
+        if self.selected_piece and self.selected_piece.image and self.dragging:
+            screen.set_clip(BOARD_RECT)
             screen.blit(self.selected_piece.image, self.selected_piece.rect)
+            screen.set_clip(None)
+
+    def mark_dirty(self, square: Square) -> None:
+        self.dirty_rects.append(pygame.Rect(self.get_screen_position(square), (SQ_SIZE, SQ_SIZE)))
+
+    def _set_valid_moves(self, moves: list[Square]) -> None:
+        for square in self.valid_moves + moves:
+            self.mark_dirty(square)
+        self.valid_moves = moves
 
-    def get_screen_position(self, board_position):
+    def get_screen_position(self, board_position: Square) -> tuple[int, int]:
         row, col = board_position
         if self.board_flipped:
             return ((7-col) * SQ_SIZE, (7-row) * SQ_SIZE)
         else:
             return (col * SQ_SIZE, row * SQ_SIZE)
 
-    def get_board_position(self, screen_position):
+    def get_board_position(self, screen_position: tuple[int, int]) -> Square:
         x, y = screen_position
         if self.board_flipped:
             return (7 - (y // SQ_SIZE), 7 - (x // SQ_SIZE))
         else:
             return (y // SQ_SIZE, x // SQ_SIZE)
 
-    def select_piece(self, pos):
+    def select_piece(self, pos: tuple[int, int]) -> None:
         if pos[1] >= BOARD_SIZE:  # Check if click is below the board
             return
         row, col = self.get_board_position(pos)
         piece = self.board[row][col]
         if piece and piece.color == self.turn:
             self.selected_piece = piece
-            self.valid_moves = self.get_legal_moves(piece)
+            self._set_valid_moves(self.get_legal_moves(piece))
             self.dragging = True
             # Update the rect of the selected piece for dragging
             self.selected_piece.rect.center = pos
+            self.dirty_rects.append(self.selected_piece.rect.copy())
         else:
             self.selected_piece = None
-            self.valid_moves = []
+            self._set_valid_moves([])
 
-    def move_piece(self, end_pos):
+    def move_piece(self, end_pos: tuple[int, int]) -> bool:
         if end_pos[1] >= BOARD_SIZE:  # Check if release is below the board
             return False
+        piece = self.selected_piece
+        if piece is None:
+            return False
         end_row, end_col = self.get_board_position(end_pos)
-        start_row, start_col = self.selected_piece.position
+        start_row, start_col = piece.position
 
         if (end_row, end_col) in self.valid_moves:
-            # Handle en passant capture
-            if isinstance(self.selected_piece, Pawn) and end_col != start_col and self.board[end_row][end_col] is None:
-                self.board[start_row][end_col] = None  # Remove the captured pawn
-
-            # Make the move
-            self.board[end_row][end_col] = self.selected_piece
-            self.board[start_row][start_col] = None
-            self.selected_piece.position = (end_row, end_col)
-            self.selected_piece.update_rect()
-
-            # Handle pawn promotion
-            if isinstance(self.selected_piece, Pawn) and (end_row == 0 or end_row == 7):
-                self.promotion_pawn = self.selected_piece
+            self.legal_moves = None
+
+            # Make the move, including any en passant capture
+            _, _, captured, captured_square = self._make(piece, (end_row, end_col))
+            piece.update_rect()
+            self.mark_dirty((start_row, start_col))
+            self.mark_dirty((end_row, end_col))
+            if captured:
+                self.mark_dirty(captured_square)
+                self.pieces_by_color[captured.color].pop(captured, None)
+            # Any move ends the previous double push's en passant window
+            if self.ep_target:
+                self.ep_target.en_passant_vulnerable = False
+                self.zobrist ^= ZOBRIST_EP[self.ep_target.position[1]]
+                self.ep_target = None
+
+            self.last_move = (start_row, start_col, end_row, end_col)
+
+            # Handle pawn promotion; promote_pawn finishes the turn
+            if isinstance(piece, Pawn) and (end_row == 0 or end_row == 7):
+                self.promotion_pawn = piece
+                self.full_redraw = True  # Promotion buttons cover the board
                 return True
 
             # Update pawn status
-            if isinstance(self.selected_piece, Pawn):
-                self.selected_piece.has_moved = True
+            if isinstance(piece, Pawn):
+                piece.has_moved = True
                 # Set en passant vulnerability
                 if abs(start_row - end_row) == 2:
-                    self.selected_piece.en_passant_vulnerable = True
-                else:
-                    self.selected_piece.en_passant_vulnerable = False
+                    piece.en_passant_vulnerable = True
+                    self.ep_target = piece
+                    self.zobrist ^= ZOBRIST_EP[end_col]
 
-            # Reset en passant vulnerability for all other pawns of the same color
-            for row in self.board:
-                for piece in row:
-                    if isinstance(piece, Pawn) and piece.color == self.selected_piece.color and piece != self.selected_piece:
-                        piece.en_passant_vulnerable = False
-
-            # Update game state
-            self.last_move = (start_row, start_col, end_row, end_col)
-            self.turn = 'black' if self.turn == 'white' else 'white'
-            self.update_check_status()
-            self.update_game_over()
-            self.update_position_history()
+            self._end_turn()
+            self._mark_status_dirty()
 
             return True
         else:
             # If the move is not valid, return the piece to its original position
-            self.selected_piece.update_rect()
+            piece.update_rect()
             return False
 
-    def promote_pawn(self, piece_class):
-        row, col = self.promotion_pawn.position
-        color = self.promotion_pawn.color
-        self.board[row][col] = piece_class(color, (row, col))
+    def promote_pawn(self, piece_class: type[Piece]) -> None:
+        pawn = self.promotion_pawn
+        if pawn is None:
+            return
+        self.legal_moves = None
+        row, col = pawn.position
+        color = pawn.color
+        promoted = piece_class(color, (row, col))
+        self._toggle_piece(pawn, (row, col))
+        self.board[row][col] = promoted
+        self._toggle_piece(promoted, (row, col))
+        self.pieces_by_color[color].pop(pawn, None)
+        self.pieces_by_color[color][promoted] = None
         self.promotion_pawn = None
 
-        # Update game state after promotion
-        self.update_check_status()
-        self.update_game_over()
+        self._end_turn()
+        self.full_redraw = True
+
+    def _end_turn(self) -> None:
+        # Hand the move to the other side and update everything that depends on it
+        self.turn = 'black' if self.turn == 'white' else 'white'
+        self.zobrist ^= ZOBRIST_SIDE
+        # Record the position first so the repetition check counts it
         self.update_position_history()
+        self._post_move_update(self.turn)
 
-    def resign(self):
+    def resign(self) -> None:
         self.game_over = True
         self.game_result = f"{'Black' if self.turn == 'white' else 'White'} wins by resignation!"
-
-    def get_legal_moves(self, piece):
-        potential_moves = piece.get_valid_moves(self.board)
+        self.full_redraw = True
+
+    def _mark_status_dirty(self) -> None:
+        # Check highlights sit on the kings; a result message needs the whole screen
+        self.mark_dirty(self.king_sq['white'])
+        self.mark_dirty(self.king_sq['black'])
+        if self.game_over:
+            self.full_redraw = True
+
+    def get_pseudo_moves(self, piece: Piece) -> list[Square]:
+        return list(self.iter_pseudo_moves(piece))
+
+    def iter_pseudo_moves(self, piece: Piece) -> Iterator[Square]:
+        # Targets are fixed here, so the board may change while the caller iterates
+        if isinstance(piece, Pawn):
+            targets = self._pawn_targets(piece)
+        else:
+            targets = piece.attacks(self.occ) & ~self.occupancy[piece.color]
+        return squares_from_bitboard(targets)
+
+    def _pawn_targets(self, pawn: Pawn) -> int:
+        row, col = pawn.position
+        direction = -1 if pawn.color == 'white' else 1
+        targets = pawn.attacks(self.occ) & self.occupancy[opponent(pawn.color)]
+
+        # Pushes, with the double step only through an empty square
+        if not (row + direction) & ~7:
+            single = 1 << square_index((row + direction, col))
+            if not self.occ & single:
+                targets |= single
+                if not pawn.has_moved:
+                    double = 1 << square_index((row + 2*direction, col))
+                    if not self.occ & double:
+                        targets |= double
+
+        # En passant behind an enemy pawn that just moved two squares beside us
+        if self.ep_target and self.ep_target.color != pawn.color:
+            ep_row, ep_col = self.ep_target.position
+            if ep_row == row and abs(ep_col - col) == 1:
+                targets |= 1 << square_index((row + direction, ep_col))
+        return targets
+
+    def get_legal_moves(self, piece: Piece) -> list[Square]:
+        if piece.color == self.turn:
+            legal_moves = self._ensure_legal_cache()
+            if piece in legal_moves:
+                return legal_moves[piece]
+        return self._compute_legal_moves(piece)
+
+    def _ensure_legal_cache(self) -> dict[Piece, list[Square]]:
+        # Built once per turn on first use, dropped whenever the board changes
+        if self.legal_moves is None:
+            self.legal_moves = {piece: self._compute_legal_moves(piece)
+                                for piece in self.pieces_by_color[self.turn]}
+        return self.legal_moves
+
+    def _compute_legal_moves(self, piece: Piece) -> list[Square]:
+        potential_moves = self.iter_pseudo_moves(piece)
         legal_moves = []
         for move in potential_moves:
             if not self.move_causes_check(piece, move):
                 legal_moves.append(move)
         return legal_moves
 
-    def move_causes_check(self, piece, move):
-        # Create a deep copy of the board
-        temp_board = [row[:] for row in self.board]
-        start_row, start_col = piece.position
-        end_row, end_col = move
-
-        # Make the move on the temporary board
-        temp_board[end_row][end_col] = piece
-        temp_board[start_row][start_col] = None
-
-        # Check if the king is in check after the move
-        king_position = self.find_king(piece.color, temp_board)
-        return self.is_square_under_attack(king_position, piece.color, temp_board)
-
-    def find_king(self, color, board):
+    def move_causes_check(self, piece: Piece, move: Square) -> bool:
+        # Play the move in place, probe, then take it back
+        undo = self._make(piece, move)
+        in_check = self.is_square_under_attack(self.find_king(piece.color, self.board), piece.color, self.board)
+        self._unmake(undo, piece)
+        return in_check
+
+    def _make(self, piece: Piece, end: Square) -> Undo:
+        start = piece.position
+        captured_square = end
+        captured = self.board[end[0]][end[1]]
+        if isinstance(piece, Pawn) and end[1] != start[1] and captured is None:
+            captured_square = (start[0], end[1])  # En passant
+            captured = self.board[start[0]][end[1]]
+
+        if captured:
+            self._toggle_piece(captured, captured_square)
+            self.board[captured_square[0]][captured_square[1]] = None
+        self._toggle_piece(piece, start)
+        self._toggle_piece(piece, end)
+        self.board[start[0]][start[1]] = None
+        self.board[end[0]][end[1]] = piece
+        piece.position = end
+        if isinstance(piece, King):
+            self.king_sq[piece.color] = end
+        return (start, end, captured, captured_square)
+
+    def _unmake(self, undo: Undo, piece: Piece) -> None:
+        start, end, captured, captured_square = undo
+        self._toggle_piece(piece, end)
+        self._toggle_piece(piece, start)
+        self.board[end[0]][end[1]] = None
+        self.board[start[0]][start[1]] = piece
+        piece.position = start
+        if isinstance(piece, King):
+            self.king_sq[piece.color] = start
+        if captured:
+            self._toggle_piece(captured, captured_square)
+            self.board[captured_square[0]][captured_square[1]] = captured
+
+    def find_king(self, color: str, board: Board) -> Square:
+        if board is self.board:
+            return self.king_sq[color]
         for row in range(8):
             for col in range(8):
-                if isinstance(board[row][col], King) and board[row][col].color == color:
+                piece = board[row][col]
+                if isinstance(piece, King) and piece.color == color:
                     return (row, col)
-        return None  # This should never happen in a valid chess game
+        raise ValueError(f"No {color} king on the board")  # This should never happen in a valid chess game
     
 
-    def is_square_under_attack(self, square, color, board):
-        for row in range(8):
-            for col in range(8):
-                piece = board[row][col]
-                if piece and piece.color != color:
-                    if square in piece.get_valid_moves(board):
-                        return True
+    # Looks outward from the square for each kind of attacker (a "superpiece")
+    # instead of generating every opposing move
+    def is_square_under_attack(self, square: Square, color: str, board: Board) -> bool:
+        if board is self.board:
+            sq = square_index(square)
+            bb, occ = self.bb, self.occ
+            off = COLOR_OFFSET[opponent(color)]
+            queens = bb[off + 4]
+            return bool((KNIGHT_ATTACKS[sq] & bb[off + 1])
+                        or (rook_attacks(sq, occ) & (bb[off + 3] | queens))
+                        or (bishop_attacks(sq, occ) & (bb[off + 2] | queens))
+                        or (PAWN_ATTACKS[color][sq] & bb[off])
+                        or (KING_ATTACKS[sq] & bb[off + 5]))
+
+        row, col = square
+        for kind, squares in ((Knight, KNIGHT_DESTS), (King, KING_DESTS)):
+            for r, c in squares[row*8 + col]:
+                piece = board[r][c]
+                if isinstance(piece, kind) and piece.color != color:
+                    return True
+
+        for kinds, directions in (((Rook, Queen), ROOK_DIRECTIONS), ((Bishop, Queen), BISHOP_DIRECTIONS)):
+            for dr, dc in directions:
+                r, c = row + dr, col + dc
+                while not (r | c) & ~7:
+                    piece = board[r][c]
+                    if piece:
+                        if isinstance(piece, kinds) and piece.color != color:
+                            return True
+                        break
+                    r, c = r + dr, c + dc
+
+        # Enemy pawns attack from the row in front of the square, as seen by color
+        r = row - 1 if color == 'white' else row + 1
+        for c in (col - 1, col + 1):
+            if not (r | c) & ~7:
+                piece = board[r][c]
+                if isinstance(piece, Pawn) and piece.color != color:
+                    return True
         return False
 
-    def update_check_status(self):
+    # Everything that depends on the new position, in one pass: check flags,
+    # the legal moves of color (the side to move) and whether the game is over
+    def _post_move_update(self, color: str) -> None:
         self.in_check['white'] = self.is_in_check('white')
         self.in_check['black'] = self.is_in_check('black')
 
-    def is_in_check(self, color):
-        king_position = self.find_king(color, self.board)
-        return self.is_square_under_attack(king_position, color, self.board)
-
-    def update_game_over(self):
-        if self.is_checkmate(self.turn):
+        if self.has_no_legal_moves(color):
             self.game_over = True
-            self.game_result = f"{'Black' if self.turn == 'white' else 'White'} wins by checkmate!"
-        elif self.is_stalemate(self.turn):
-            self.game_over = True
-            self.game_result = "Draw by stalemate!"
+            if self.in_check[color]:
+                self.game_result = f"{'Black' if color == 'white' else 'White'} wins by checkmate!"
+            else:
+                self.game_result = "Draw by stalemate!"
         elif self.is_draw_by_repetition():
             self.game_over = True
             self.game_result = "Draw by repetition!"
 
-    def is_checkmate(self, color):
+    def is_in_check(self, color: str) -> bool:
+        king_position = self.find_king(color, self.board)
+        return self.is_square_under_attack(king_position, color, self.board)
+
+    def is_checkmate(self, color: str) -> bool:
         if not self.in_check[color]:
             return False
         return self.has_no_legal_moves(color)
 
-    def is_stalemate(self, color):
+    def is_stalemate(self, color: str) -> bool:
         if self.in_check[color]:
             return False
         return self.has_no_legal_moves(color)
 
-    def has_no_legal_moves(self, color):
-        for row in range(8):
-            for col in range(8):
-                piece = self.board[row][col]
-                if piece and piece.color == color:
-                    if self.get_legal_moves(piece):
-                        return False
+    def has_no_legal_moves(self, color: str) -> bool:
+        if color == self.turn:
+            return not any(self._ensure_legal_cache().values())
+        # Stop at the first legal move rather than listing them all
+        for piece in self.pieces_by_color[color]:
+            for move in self.iter_pseudo_moves(piece):
+                if not self.move_causes_check(piece, move):
+                    return False
         return True
 
-    def update_position_history(self):
+    def update_position_history(self) -> None:
         position = self.get_current_position()
         self.position_history.append(position)
+        self.position_counts[position] += 1
 
-    def get_current_position(self):
-        return tuple(tuple(row) for row in self.board)
+    def get_current_position(self) -> int:
+        return self.zobrist
 
-    def is_draw_by_repetition(self):
+    def is_draw_by_repetition(self) -> bool:
         if len(self.position_history) < 8:  # Need at least 8 moves for a 3-fold repetition
             return False
-        position_counts = Counter(self.position_history)
-        return any(count >= 3 for count in position_counts.values())
+        # Earlier positions were checked when they were recorded, so only the latest can newly reach 3
+        return self.position_counts[self.position_history[-1]] >= 3
 
-    def handle_click(self, pos):
+    def handle_click(self, pos: tuple[int, int]) -> None:
         if not self.game_over:
             if not self.selected_piece:
                 self.select_piece(pos)
             else:
                 if self.move_piece(pos):
                     self.selected_piece = None
-                    self.valid_moves = []
+                    self._set_valid_moves([])
                 else:
                     self.select_piece(pos)
 
-    def handle_drag(self, pos):
+    def handle_drag(self, pos: tuple[int, int]) -> None:
         if self.selected_piece and self.dragging and not self.game_over:
+            self.dirty_rects.append(self.selected_piece.rect.copy())
             self.selected_piece.rect.center = pos
+            self.dirty_rects.append(self.selected_piece.rect.copy())
 
-    def handle_release(self, pos):
+    def handle_release(self, pos: tuple[int, int]) -> None:
         if self.selected_piece and self.dragging and not self.game_over:
+            self.dirty_rects.append(self.selected_piece.rect.copy())
             self.move_piece(pos)
             self.selected_piece = None
-            self.valid_moves = []
+            self._set_valid_moves([])
             self.dragging = False
 
-    def flip_board(self):
+    def flip_board(self) -> None:
         self.board_flipped = not self.board_flipped
+        self.full_redraw = True
 
 
-def draw_button(screen, text, position, size):
-    font = pygame.font.Font(None, 30)
-    text_render = font.render(text, True, BLACK)
+def draw_button(screen: pygame.Surface, text: str, position: tuple[int, int], size: tuple[int, int]) -> pygame.Rect:
+    text_render = render_text(text, 30)
     button_rect = pygame.Rect(position, size)
     pygame.draw.rect(screen, WHITE, button_rect)
     pygame.draw.rect(screen, BLACK, button_rect, 2)
@@ -434,16 +787,15 @@ def draw_button(screen, text, position, size):
     screen.blit(text_render, text_rect)
     return button_rect
 
-def main():
+def main() -> None:
     screen = pygame.display.set_mode((WIDTH, HEIGHT + 50))  # Extra height for buttons
     pygame.display.set_caption("Chess Game")
     clock = pygame.time.Clock()
     
-    def show_start_screen():
+    def show_start_screen() -> str:
         while True:
             screen.fill(WHITE)
-            title_font = pygame.font.Font(None, 50)
-            title_text = title_font.render("Chess Game", True, BLACK)
+            title_text = render_text("Chess Game", 50)
             screen.blit(title_text, (WIDTH//2 - title_text.get_width()//2, 50))
             
             white_button = draw_button(screen, "Play as White", (WIDTH//4 - 75, HEIGHT//2), (150, 50))
@@ -465,11 +817,30 @@ def main():
     game = ChessGame(player_color)
 
     while True:
-        flip_button = draw_button(screen, "Flip Board", (10, HEIGHT + 10), (120, 30))
-        resign_button = draw_button(screen, "Resign", (140, HEIGHT + 10), (120, 30))
-        restart_button = draw_button(screen, "Restart", (270, HEIGHT + 10), (120, 30))
+        # Repaint everything only when the layout changed, otherwise just the dirty squares
+        if game.full_redraw:
+            screen.fill(LIGHT_SQUARE)
+            game.draw_board_full(screen)
+            flip_button = draw_button(screen, "Flip Board", (10, HEIGHT + 10), (120, 30))
+            resign_button = draw_button(screen, "Resign", (140, HEIGHT + 10), (120, 30))
+            restart_button = draw_button(screen, "Restart", (270, HEIGHT + 10), (120, 30))
+
+            promotion_buttons: Optional[dict[type[Piece], pygame.Rect]] = None
+            if game.promotion_pawn:
+                promotion_pieces: list[type[Piece]] = [Queen, Rook, Bishop, Knight]
+                promotion_buttons = {}
+                for i, piece in enumerate(promotion_pieces):
+                    button = draw_button(screen, piece.__name__, (i * (WIDTH//4) + WIDTH//8 - 40, HEIGHT//2 - 25), (80, 50))
+                    promotion_buttons[piece] = button
+
+            if game.game_over and game.game_result:
+                text = render_text(game.game_result, 36)
+                text_rect = text.get_rect(center=(WIDTH//2, HEIGHT + 25))
+                screen.blit(text, text_rect)
 
-        promotion_buttons = None
+            pygame.display.flip()
+        else:
+            pygame.display.update(game.draw_board_dirty(screen))
 
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
@@ -496,26 +867,6 @@ def main():
             elif event.type == pygame.MOUSEBUTTONUP:
                 game.handle_release(event.pos)
 
-        screen.fill(LIGHT_SQUARE)
-        game.draw_board(screen)
-        flip_button = draw_button(screen, "Flip Board", (10, HEIGHT + 10), (120, 30))
-        resign_button = draw_button(screen, "Resign", (140, HEIGHT + 10), (120, 30))
-        restart_button = draw_button(screen, "Restart", (270, HEIGHT + 10), (120, 30))
-
-        if game.promotion_pawn:
-            promotion_pieces = [Queen, Rook, Bishop, Knight]
-            promotion_buttons = {}
-            for i, piece in enumerate(promotion_pieces):
-                button = draw_button(screen, piece.__name__, (i * (WIDTH//4) + WIDTH//8 - 40, HEIGHT//2 - 25), (80, 50))
-                promotion_buttons[piece] = button
-
-        if game.game_over:
-            font = pygame.font.Font(None, 36)
-            text = font.render(game.game_result, True, BLACK)
-            text_rect = text.get_rect(center=(WIDTH//2, HEIGHT + 25))
-            screen.blit(text, text_rect)
-
-        pygame.display.flip()
         clock.tick(60)
 
 if __name__ == "__main__":